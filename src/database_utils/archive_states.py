@@ -0,0 +1,152 @@
+"""
+	Move long idle users out of the active state collection. Generated bots
+	restore an archived user's state lazily on their next message, so this
+	script only has to compact and move documents. Meant to be run on a
+	schedule (e.g. Heroku Scheduler or cron) rather than from the webhook.
+
+	Usage
+	-----
+	python database_utils/archive_states.py --expiry-days 30 \
+		--max-documents 10000
+"""
+import argparse
+import datetime as dt
+import json
+import os
+
+from pymongo import MongoClient, ReplaceOne
+
+
+SYSTEM_DATABASES = ["admin", "local", "config"]
+
+# state fields that are derived from the bot configuration and are rebuilt
+# from the state template when an archived user returns
+NODE_CONFIG_FIELDS = ["length", "list", "target"]
+
+
+def compact_state(state_map):
+	"""
+		Strip a state document down to per-node progress and collected data.
+
+		Parameters
+		----------
+		state_map : {dict}
+			state document retrieved from the state collection
+	"""
+	compact = {}
+
+	for field, value in state_map.iteritems():
+		if field == "_id":
+			continue
+
+		if isinstance(value, dict) and "switch" in value:
+			value = dict((k, v) for k, v in value.iteritems()
+						 if k not in NODE_CONFIG_FIELDS)
+
+		compact[field] = value
+
+	return compact
+
+
+def archive_key(state_map):
+	"""
+		Key identifying a user's archived state; includes the tenant in the
+		shared layout.
+
+		Parameters
+		----------
+		state_map : {dict}
+			state document holding at least user_id
+	"""
+	key = {"user_id": state_map["user_id"]}
+
+	if "tenant_id" in state_map:
+		key["tenant_id"] = state_map["tenant_id"]
+
+	return key
+
+
+def archive(db, expiry_days, batch_size=500, max_documents=10000):
+	"""
+		Archive state documents idle for longer than expiry_days, one batch at
+		a time. Each batch costs one bulk upsert and one bulk remove.
+
+		Parameters
+		----------
+		db : {pymongo.database.Database}
+			bot database holding the state and state_archive collections
+
+		expiry_days : {int}
+			users idle for longer than this are archived
+
+		batch_size : {int}
+			number of state documents moved per round trip
+
+		max_documents : {int}
+			upper bound on documents archived by a single run
+	"""
+	cutoff = dt.datetime.utcnow() - dt.timedelta(days=expiry_days)
+
+	archived = 0
+	processed = 0
+
+	while processed < max_documents:
+		limit = min(batch_size, max_documents - processed)
+
+		batch = list(db["state"].find({"last_seen": {"$lt": cutoff}})
+					 .limit(limit))
+
+		if not batch:
+			break
+
+		operations = []
+
+		for state_map in batch:
+			# upsert so that a run interrupted before the remove is harmless
+			operations.append(ReplaceOne(archive_key(state_map),
+										 compact_state(state_map), upsert=True))
+
+		db["state_archive"].bulk_write(operations, ordered=False)
+
+		ids = [state_map["_id"] for state_map in batch]
+
+		# users who messaged since the batch was read have a fresh last_seen
+		# and newer progress - leave them in state
+		result = db["state"].remove({"_id": {"$in": ids},
+									 "last_seen": {"$lt": cutoff}})
+
+		archived += result["n"]
+		processed += len(batch)
+
+		if result["n"] < len(batch):
+			# their archive copies are stale and must never be restored
+			returned = [archive_key(state_map) for state_map in
+						db["state"].find({"_id": {"$in": ids}},
+										 {"user_id": 1, "tenant_id": 1})]
+
+			if returned:
+				db["state_archive"].remove({"$or": returned})
+
+	return archived
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+	parser.add_argument("--database", action="append", dest="databases")
+	parser.add_argument("--expiry-days", type=int, default=30)
+	parser.add_argument("--batch-size", type=int, default=500)
+	parser.add_argument("--max-documents", type=int, default=10000)
+
+	args = parser.parse_args()
+
+	client = MongoClient(os.environ["MONGO_HOST"])
+
+	# one database per bot by default; the shared layout has a single one
+	databases = args.databases or \
+		[name for name in client.database_names()
+		 if name not in SYSTEM_DATABASES]
+
+	print json.dumps(dict(
+		(name, archive(client[name], args.expiry_days, args.batch_size,
+					   args.max_documents)) for name in databases),
+		indent=4, sort_keys=True)
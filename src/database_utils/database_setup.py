@@ -1,12 +1,17 @@
 """
 	Clean database prior to running engine. Used strictly for engine testing.
+
+	Usage
+	-----
+	python database_utils/database_setup.py [tenant_id] [database]
 """
 import os
+import sys
 
 from pymongo import MongoClient
 
 
-def clean(mongo_host):
+def clean(mongo_host, tenant_id=None, database="botengine"):
 	"""
 		Commands used to clean database prior to running engine.
 
@@ -14,16 +19,30 @@ def clean(mongo_host):
 		----------
 		mongo_host : {string}
 			mongo host ip which should be stored as env var
+
+		tenant_id : {string}
+			when specified, only the records of this tenant are removed from
+			the shared collections; all other tenants are left untouched
+
+		database : {string}
+			database to clean; for the shared layout this must match the
+			bot configuration's shared_database
 	"""
 	client = MongoClient(mongo_host)
-	db = client["botengine"]
+	db = client[database]
 
 	colls = db.collection_names(include_system_collections=False)
 
 	for coll in colls:
-		db[coll].drop()
+		if tenant_id is None:
+			db[coll].drop()
+		else:
+			db[coll].remove({"tenant_id": tenant_id})
 
 	return True
 
 if __name__ == '__main__':
-	print clean(os.environ["MONGO_HOST"])
+	tenant_id = sys.argv[1] if len(sys.argv) > 1 else None
+	database = sys.argv[2] if len(sys.argv) > 2 else "botengine"
+
+	print clean(os.environ["MONGO_HOST"], tenant_id, database)
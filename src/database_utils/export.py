@@ -0,0 +1,528 @@
+"""
+	Streaming export of data collected by generated bots. Each tenant's
+	collections are written to NDJSON, CSV, or Parquet files using batched
+	cursors, so memory use is bounded by the batch size rather than the
+	collection size.
+
+	Usage
+	-----
+	python database_utils/export.py --format ndjson --output exports \
+		--incremental --processes 4
+
+	Bots generated with the shared layout keep every tenant in one database;
+	pass --shared-database to export each tenant_id from it.
+"""
+import argparse
+import csv
+import datetime as dt
+import json
+import os
+from multiprocessing import Pool
+
+from bson import ObjectId, json_util
+from pymongo import ASCENDING, MongoClient
+
+try:
+	import pyarrow
+	import pyarrow.parquet
+except ImportError:
+	pyarrow = None
+
+
+SYSTEM_DATABASES = ["admin", "local", "config"]
+
+# per-user working documents rewritten in place by the webhook - not data
+# collected through storage specs, so only exported on request
+STATE_COLLECTIONS = ["state", "state_archive"]
+
+# flow records are stamped with this format by the generated webhook
+DATE_FORMAT = "%d-%m-%Y"
+
+FILE_EXTENSIONS = {
+	"ndjson": "ndjson",
+	"csv": "csv",
+	"parquet": "parquet"
+}
+
+
+def flatten(record, encode_text=True):
+	"""
+		Convert a mongo document into a flat row of scalar values suitable for
+		tabular formats. Nested values are serialized as JSON.
+
+		Parameters
+		----------
+		record : {dict}
+			document retrieved from a tenant collection
+
+		encode_text : {bool}
+			encode unicode values as UTF-8 bytes; the csv module needs bytes
+			while Parquet needs unicode to type the column as string
+	"""
+	row = {}
+
+	for field, value in record.iteritems():
+		if isinstance(value, ObjectId):
+			value = str(value)
+		elif isinstance(value, (dict, list)):
+			value = json_util.dumps(value)
+		elif isinstance(value, unicode) and encode_text:
+			value = value.encode("utf-8")
+
+		row[field] = value
+
+	return row
+
+
+class NDJSONWriter:
+	"""
+		Writes one JSON document per line. Schema changes require no special
+		handling.
+	"""
+	def __init__(self, path):
+		self.file = open(path, "w")
+
+	def write_batch(self, batch):
+		for record in batch:
+			self.file.write(json_util.dumps(record))
+			self.file.write("\n")
+
+	def close(self):
+		self.file.close()
+
+
+class TabularWriter:
+	"""
+		Base writer for formats with a fixed column set. Columns are taken
+		from the first batch; a batch introducing new fields starts a new part
+		file rather than buffering the collection to discover its schema.
+	"""
+	encode_text = True
+
+	def __init__(self, path):
+		self.base, self.extension = os.path.splitext(path)
+		self.part = 0
+		self.columns = None
+
+	def part_path(self):
+		if self.part == 0:
+			return self.base + self.extension
+
+		return "%s.part-%04d%s" % (self.base, self.part, self.extension)
+
+	def write_batch(self, batch):
+		rows = [flatten(record, self.encode_text) for record in batch]
+
+		fields = set()
+		for row in rows:
+			fields.update(row.keys())
+
+		if self.columns is None or not fields.issubset(self.columns):
+			if self.columns is not None:
+				self.close()
+				self.part += 1
+
+			self.columns = sorted(fields | set(self.columns or []))
+			self.open(self.part_path())
+
+		self.write_rows(rows)
+
+
+class CSVWriter(TabularWriter):
+	"""
+		Writes rows as CSV with a header per part file.
+	"""
+	def open(self, path):
+		self.file = open(path, "wb")
+		self.writer = csv.DictWriter(self.file, fieldnames=self.columns)
+		self.writer.writeheader()
+
+	def write_rows(self, rows):
+		self.writer.writerows(rows)
+
+	def close(self):
+		if self.columns is not None:
+			self.file.close()
+
+
+class ParquetWriter(TabularWriter):
+	"""
+		Writes each batch as a Parquet row group. Requires pyarrow.
+	"""
+	encode_text = False
+
+	def open(self, path):
+		self.path = path
+		self.writer = None
+
+	def write_rows(self, rows):
+		arrays = [column_array([row.get(col) for row in rows])
+				  for col in self.columns]
+		table = pyarrow.Table.from_arrays(arrays, names=self.columns)
+
+		if self.writer is None:
+			self.writer = pyarrow.parquet.ParquetWriter(self.path, table.schema)
+		elif not table.schema.equals(self.writer.schema):
+			# column types drifted within the same field set - start a new part
+			self.close()
+			self.part += 1
+			self.open(self.part_path())
+			self.writer = pyarrow.parquet.ParquetWriter(self.path, table.schema)
+
+		self.writer.write_table(table)
+
+	def close(self):
+		if self.columns is not None and self.writer is not None:
+			self.writer.close()
+
+
+def column_array(values):
+	"""
+		Build an Arrow array for one column of a batch. Columns mixing types -
+		e.g. raw text answers stored before typed coercion next to native
+		numbers or dates - fall back to strings instead of failing the batch.
+
+		Parameters
+		----------
+		values : {list}
+			column values, with None for missing fields
+	"""
+	try:
+		return pyarrow.array(values)
+	except (TypeError, ValueError):
+		# ArrowInvalid and ArrowTypeError subclass these
+		return pyarrow.array(
+			[None if value is None else unicode(value) for value in values],
+			type=pyarrow.string())
+
+
+def parse_flow_date(record):
+	"""
+		Parse a record's flow date, returning None when it is missing or
+		malformed.
+	"""
+	try:
+		return dt.datetime.strptime(record["date"], DATE_FORMAT)
+	except (KeyError, TypeError, ValueError):
+		return None
+
+
+WRITERS = {
+	"ndjson": NDJSONWriter,
+	"csv": CSVWriter,
+	"parquet": ParquetWriter
+}
+
+
+def load_watermarks(path):
+	"""
+		Read the per-collection watermarks for a tenant, if any exist.
+	"""
+	if not os.path.exists(path):
+		return {}
+
+	with open(path) as file:
+		return json.load(file)
+
+
+def save_watermarks(path, watermarks):
+	"""
+		Persist watermarks atomically so an interrupted export never records
+		progress it did not make.
+	"""
+	tmp_path = "%s.tmp" % path
+
+	with open(tmp_path, "w") as file:
+		json.dump(watermarks, file, indent=4, sort_keys=True)
+
+	os.rename(tmp_path, path)
+
+
+def export_collection(coll, writer, since_field, watermark, batch_size,
+					  tenant_fields=None):
+	"""
+		Stream a single collection through a writer, returning the number of
+		exported records, the number of records with a malformed flow date,
+		and the new watermark.
+
+		Parameters
+		----------
+		coll : {pymongo.collection.Collection}
+			collection to export
+
+		writer : {NDJSONWriter, CSVWriter, ParquetWriter}
+			destination for exported batches
+
+		since_field : {string}
+			"_id" or "date"; field used for incremental exports
+
+		watermark : {string, dict}
+			for "_id", the last exported id; for "date", the last exported day
+			and the ids already exported on it; None for a full export
+
+		batch_size : {int}
+			number of documents fetched and written per batch
+
+		tenant_fields : {dict}
+			tenant filter for collections shared between tenants
+	"""
+	query = {"record": {"$ne": "placecholder"}}
+	query.update(tenant_fields or {})
+
+	if since_field == "_id" and watermark is not None:
+		query["_id"] = {"$gt": ObjectId(watermark)}
+
+	# flow dates are stored as day-month-year strings, which do not sort, so
+	# date watermarks are compared after parsing. The watermark day itself is
+	# exported again on the next run, minus the ids already written, because
+	# records can still be stamped with it after this run finishes
+	min_date = None
+	seen_ids = set()
+
+	if since_field == "date" and watermark is not None:
+		min_date = dt.datetime.strptime(watermark["date"], DATE_FORMAT)
+		seen_ids = set(watermark["ids"])
+
+		# records are stamped with the server's local date when inserted, so
+		# their ids cannot predate the watermark day by more than a timezone
+		# offset - bound the cursor instead of scanning the whole collection
+		query["_id"] = {
+			"$gte": ObjectId.from_datetime(min_date - dt.timedelta(days=1))
+		}
+
+	cursor = coll.find(query).sort("_id", ASCENDING).batch_size(batch_size)
+
+	count = 0
+	malformed = 0
+	batch = []
+
+	max_date = min_date
+	max_date_ids = set(seen_ids)
+
+	for record in cursor:
+		if since_field == "date":
+			record_date = parse_flow_date(record)
+
+			if record_date is None:
+				if "date" in record:
+					malformed += 1
+
+				# only flow records are dated - undated or malformed records
+				# cannot be placed relative to a watermark, so only full
+				# exports include them
+				if min_date is not None:
+					continue
+			else:
+				if min_date is not None and (record_date < min_date or (
+						record_date == min_date and
+						str(record["_id"]) in seen_ids)):
+					continue
+
+				if max_date is None or record_date > max_date:
+					max_date = record_date
+					max_date_ids = set()
+
+				if record_date == max_date:
+					max_date_ids.add(str(record["_id"]))
+		else:
+			watermark = str(record["_id"])
+
+		batch.append(record)
+
+		if len(batch) >= batch_size:
+			writer.write_batch(batch)
+			count += len(batch)
+			batch = []
+
+	if batch:
+		writer.write_batch(batch)
+		count += len(batch)
+
+	if since_field == "date" and max_date is not None:
+		watermark = {
+			"date": max_date.strftime(DATE_FORMAT),
+			"ids": sorted(max_date_ids)
+		}
+
+	return count, malformed, watermark
+
+
+def export_tenant(args):
+	"""
+		Export the data collections of a single tenant. Runs inside a pool
+		worker, so it opens its own client.
+
+		Parameters
+		----------
+		args : {tuple}
+			(mongo_host, tenant, options) where options is a dict holding the
+			parsed command line options
+	"""
+	mongo_host, tenant, options = args
+
+	client = MongoClient(mongo_host)
+
+	if options["shared_database"]:
+		db = client[options["shared_database"]]
+		tenant_fields = {"tenant_id": tenant}
+	else:
+		db = client[tenant]
+		tenant_fields = None
+
+	tenant_dir = os.path.join(options["output"], tenant)
+	run_dir = os.path.join(tenant_dir, options["run_id"])
+
+	if not os.path.exists(run_dir):
+		os.makedirs(run_dir)
+
+	watermark_path = os.path.join(tenant_dir, "watermarks.json")
+	watermarks = load_watermarks(watermark_path) \
+		if options["incremental"] else {}
+
+	summary = {}
+
+	for coll in db.collection_names(include_system_collections=False):
+		if coll in STATE_COLLECTIONS and not options["include_state"]:
+			continue
+
+		key = "%s:%s" % (coll, options["since_field"])
+
+		path = os.path.join(
+			run_dir, "%s.%s" % (coll, FILE_EXTENSIONS[options["format"]]))
+		writer = WRITERS[options["format"]](path)
+
+		try:
+			try:
+				count, malformed, watermark = export_collection(
+					db[coll], writer, options["since_field"],
+					watermarks.get(key), options["batch_size"], tenant_fields)
+			finally:
+				writer.close()
+		except Exception as e:
+			# report the failure and move on - the watermark is not advanced,
+			# so the next run retries the collection
+			summary[coll] = {"error": "%s: %s" % (type(e).__name__, e)}
+			continue
+
+		if count == 0 and os.path.exists(path):
+			os.remove(path)
+
+		if watermark is not None:
+			watermarks[key] = watermark
+
+		summary[coll] = {"exported": count, "malformed_dates": malformed}
+
+	if options["incremental"]:
+		save_watermarks(watermark_path, watermarks)
+
+	client.close()
+
+	return tenant, summary
+
+
+def export(mongo_host, output, export_format="ndjson", tenants=None,
+		   since_field="_id", incremental=False, batch_size=1000, processes=4,
+		   shared_database=None, include_state=False):
+	"""
+		Export tenant databases in parallel.
+
+		Parameters
+		----------
+		mongo_host : {string}
+			mongo host ip which should be stored as env var
+
+		output : {string}
+			directory receiving one sub-directory per tenant
+
+		export_format : {string}
+			one of "ndjson", "csv", or "parquet"
+
+		tenants : {list}
+			tenant (user id) databases to export; defaults to all databases,
+			or to every tenant_id in the shared database
+
+		since_field : {string}
+			"_id" or "date"; watermark field for incremental exports
+
+		incremental : {bool}
+			only export records past the stored watermark, then advance it
+
+		batch_size : {int}
+			cursor batch size and number of records written per batch
+
+		processes : {int}
+			number of tenants exported concurrently
+
+		shared_database : {string}
+			database holding all tenants in the shared layout
+
+		include_state : {bool}
+			also export the state and state_archive collections
+	"""
+	if export_format == "parquet" and pyarrow is None:
+		raise ImportError("pyarrow is required for parquet exports")
+
+	if tenants is None:
+		client = MongoClient(mongo_host)
+
+		if shared_database:
+			# tenants whose users are all archived have no state records, so
+			# look in every collection rather than just state
+			db = client[shared_database]
+			tenants = set()
+
+			for coll in db.collection_names(include_system_collections=False):
+				tenants.update(db[coll].distinct("tenant_id"))
+
+			tenants = sorted(tenant for tenant in tenants if tenant is not None)
+		else:
+			tenants = [name for name in client.database_names()
+					   if name not in SYSTEM_DATABASES]
+
+		client.close()
+
+	options = {
+		"output": output,
+		"format": export_format,
+		"since_field": since_field,
+		"incremental": incremental,
+		"batch_size": batch_size,
+		"shared_database": shared_database,
+		"include_state": include_state,
+		"run_id": dt.datetime.utcnow().strftime("%Y%m%dT%H%M%S")
+	}
+
+	pool = Pool(processes=max(1, min(processes, len(tenants))))
+
+	try:
+		results = pool.map(
+			export_tenant, [(mongo_host, tenant, options) for tenant in tenants])
+	finally:
+		pool.close()
+		pool.join()
+
+	return dict(results)
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+	parser.add_argument("--format", choices=sorted(WRITERS.keys()),
+						default="ndjson")
+	parser.add_argument("--output", default="exports")
+	parser.add_argument("--tenant", action="append", dest="tenants")
+	parser.add_argument("--since-field", choices=["_id", "date"], default="_id")
+	parser.add_argument("--incremental", action="store_true")
+	parser.add_argument("--batch-size", type=int, default=1000)
+	parser.add_argument("--processes", type=int, default=4)
+	parser.add_argument("--shared-database")
+	parser.add_argument("--include-state", action="store_true")
+
+	args = parser.parse_args()
+
+	print json.dumps(export(
+		os.environ["MONGO_HOST"], args.output, export_format=args.format,
+		tenants=args.tenants, since_field=args.since_field,
+		incremental=args.incremental, batch_size=args.batch_size,
+		processes=args.processes, shared_database=args.shared_database,
+		include_state=args.include_state),
+		indent=4, sort_keys=True)
@@ -8,7 +8,9 @@
         "collections": [
             "user",
             "transactions"
-        ]
+        ],
+        "layout": "shared",
+        "shared_database": "botengine"
     }
 
     - bot flow configuration
@@ -74,13 +76,27 @@
 import json
 import os
 import shutil
+import time
 
-from pymongo import MongoClient
+from pymongo import ASCENDING, MongoClient
 
 import templates as tl
 from utils import format_string
 
 
+# accepted expected_input spellings and the coercer each compiles to
+INPUT_TYPES = {
+    "int": "integer",
+    "integer": "integer",
+    "float": "float",
+    "number": "float",
+    "date": "date",
+    "str": "text",
+    "string": "text",
+    "text": "text"
+}
+
+
 class Engine: 
     """
         Primary engine class for parsing JSON into application logic.
@@ -110,6 +126,10 @@ class Engine:
 
             mongo_host : {string}
                 database url; should include appropriate port
+
+            client : {pymongo.MongoClient}
+                existing client to reuse; a new client is connected to
+                mongo_host when omitted
         """
         self.user_id = user_id
         self.json_data = json.loads(json_string)
@@ -127,14 +147,28 @@ class Engine:
         # make user directory
         os.makedirs(self.output_dir)
 
-        # database config
-        self.client = MongoClient(self.mongo_host)
-        self.db = self.client[self.user_id]
-
         # bot application config
         self.bot_configuration = self.json_data["bot_configuration"]
         self.database_configuration = self.json_data["database_configuration"]
 
+        # database config - by default each bot gets its own database; the
+        # shared layout keys every record on tenant_id in a single database
+        self.shared = self.database_configuration.get("layout") == "shared"
+
+        if self.shared:
+            self.database_name = \
+                self.database_configuration.get("shared_database", "botengine")
+            self.tenant_fields = {"tenant_id": self.user_id}
+        else:
+            self.database_name = self.user_id
+            self.tenant_fields = {}
+
+        self.client = kwargs.get("client") or MongoClient(self.mongo_host)
+        self.db = self.client[self.database_name]
+
+        # seconds spent in each process step
+        self.timings = {}
+
         self.carousels = \
             [(name, data) for name, data in self.bot_configuration.iteritems() 
              if data["type"] == "carousel"]
@@ -153,9 +187,30 @@ class Engine:
         """
         db_config = self.database_configuration
 
+        if self.shared:
+            # collections are shared between tenants, so creating the
+            # compound indexes is enough to create them - no placeholders
+            for coll in db_config["collections"] + ["state", "state_archive"]:
+                self.db[coll].create_index([("tenant_id", ASCENDING),
+                                            ("user_id", ASCENDING)])
+
+            # per-tenant exports filter on tenant_id and page through _id
+            for coll in db_config["collections"]:
+                self.db[coll].create_index([("tenant_id", ASCENDING),
+                                            ("_id", ASCENDING)])
+
+            # the archive sweep scans last_seen across all tenants
+            self.db["state"].create_index("last_seen")
+            return
+
         for coll in db_config["collections"] + ["state"]:
             self.db[coll].insert({"record": "placecholder"})
 
+        # state lookups are keyed on user id; expiry sweeps scan last_seen
+        self.db["state"].create_index("user_id")
+        self.db["state"].create_index("last_seen")
+        self.db["state_archive"].create_index("user_id")
+
 
     def webhook_logic(self):
         """
@@ -181,7 +236,7 @@ class Engine:
                 if "storage" in option:
                     data_insertion = \
 """
-state_coll.update({"user_id": sender_id}, {
+state_coll.update(state_key(sender_id), {
     "$set": {
         "data.%s": message_payload
     }
@@ -304,15 +359,44 @@ state_coll.update({"user_id": sender_id}, {
         file_content = \
 """
 state_map = ~state_map_content~
+
+input_table = ~input_table_content~
 """
 
         # write state map to file
         with open("%s/state.py" % self.output_dir, "w") as file:
-            file.write(format_string(file_content, state_map_content=state_map))
+            file.write(format_string(file_content, state_map_content=state_map,
+                                     input_table_content=self.input_table()))
 
         return state_map
 
 
+    def input_table(self):
+        """
+            Method to compile message list "expected_input" types into a table
+            mapping each message's content name (<node>_<index>) to the coercer
+            applied to the answer. Messages without an expected input are
+            omitted and their answers are stored as raw text.
+        """
+        table = {}
+
+        for name, data in self.message_lists:
+            for idx, msg in enumerate(data["messages"]):
+                if "expected_input" not in msg:
+                    continue
+
+                expected = str(msg["expected_input"]).lower()
+
+                if expected not in INPUT_TYPES:
+                    raise ValueError(
+                        "unsupported expected_input '%s' for message %s_%s" %
+                        (msg["expected_input"], name, idx))
+
+                table["%s_%s" % (name, idx)] = INPUT_TYPES[expected]
+
+        return table
+
+
     def logic_creation(self):
         """
             Primary method for bot/application logic creation. Outputs to 
@@ -321,8 +405,10 @@ state_map = ~state_map_content~
 
         al = format_string(
             tl.base_application_logic, mongo_host=self.mongo_host,
-            user_id=self.user_id, page_access_token=self.pat, 
-            verify_token=self.vt, webhook_logic=self.webhook_logic())
+            database_name=self.database_name,
+            tenant_fields=self.tenant_fields, page_access_token=self.pat, 
+            verify_token=self.vt,
+            webhook_logic=self.webhook_logic())
 
         # write content t ofile
         with open("%s/app.py" % self.output_dir, "w") as file:
@@ -373,16 +459,16 @@ gunicorn
             particular order. The end results are application and content files
             deployed and configured for the engine-user's facebook page.
         """
+        steps = [self.database_config, self.content_creation,
+                 self.logic_creation, self.procfile_creation,
+                 self.requirements_creation]
 
-        self.database_config()
-
-        self.content_creation()
-
-        self.logic_creation()
+        for step in steps:
+            start = time.time()
 
-        self.procfile_creation()
+            step()
 
-        self.requirements_creation()
+            self.timings[step.__name__] = time.time() - start
 
         # return a string containing user_id, page access token, verify token
         return "%s,%s,%s" % (self.user_id, self.pat, self.vt)
@@ -2,7 +2,16 @@
 source evars.sh
 
 # clean database - only for testing
-python database_utils/database_setup.py
+# under the shared layout only this bot's tenant records are removed, since
+# the database also holds every other tenant (tenant id = engine.py user id)
+tenant_id="botengine"
+db_layout=($(python -c 'import json; c = json.load(open("bot-config.json"))["database_configuration"]; print c.get("layout", "database"), c.get("shared_database", "botengine")'))
+
+if [ "${db_layout[0]}" == "shared" ]; then
+    python database_utils/database_setup.py $tenant_id ${db_layout[1]}
+else
+    python database_utils/database_setup.py
+fi
 
 # run engine and retrieve user id
 engine_output="$(python engine.py)"
@@ -0,0 +1,222 @@
+"""
+    Generation service wrapping the engine. Bot configurations are accepted as
+    JSON over HTTP and queued to a bounded pool of worker threads. The mongo
+    client and the parsed templates stay warm between jobs, so each generation
+    only pays for its own database setup and file output.
+
+    Jobs are tracked in memory - run a single server process (e.g.
+    gunicorn --workers 1 --threads 8 server:app) and scale the pool through
+    ENGINE_WORKERS instead.
+
+    Example request
+    ---------------
+    POST /bots
+    {
+        "user_id": "botengine",
+        "page_access_token": "...",
+        "verification_token": "...",
+        "configuration": {
+            "database_configuration": {...},
+            "bot_configuration": {...}
+        },
+        "include_artifacts": false
+    }
+"""
+import collections
+import copy
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+import uuid
+from multiprocessing.pool import ThreadPool
+
+from flask import Flask, jsonify, request
+from pymongo import MongoClient
+
+from engine import Engine
+
+
+app = Flask(__name__)
+
+# worker pool constants
+WORKERS = int(os.environ.get("ENGINE_WORKERS", 4))
+MAX_PENDING = int(os.environ.get("ENGINE_MAX_PENDING", 64))
+MAX_FINISHED = int(os.environ.get("ENGINE_MAX_FINISHED", 1000))
+
+# user ids become output directory names
+USER_ID_PATTERN = re.compile(r"^[A-Za-z0-9_-]+$")
+
+# shared across jobs - MongoClient maintains its own thread-safe pool
+client = MongoClient(os.environ["MONGO_HOST"])
+pool = ThreadPool(WORKERS)
+
+jobs = collections.OrderedDict()
+jobs_lock = threading.Lock()
+
+
+def artifact_digests(output_dir, include_artifacts):
+    """
+        Hash every generated file, optionally including the file contents.
+
+        Parameters
+        ----------
+        output_dir : {string}
+            engine output directory for a single bot
+
+        include_artifacts : {bool}
+            whether file contents should be returned along with the hashes
+    """
+    artifacts = {}
+
+    for name in sorted(os.listdir(output_dir)):
+        with open(os.path.join(output_dir, name)) as file:
+            content = file.read()
+
+        artifacts[name] = {"sha256": hashlib.sha256(content).hexdigest()}
+
+        if include_artifacts:
+            artifacts[name]["content"] = content
+
+    return artifacts
+
+
+def run_job(job_id):
+    """
+        Worker entry point. Runs the engine for a queued job and records the
+        outcome and timings on the job.
+
+        Parameters
+        ----------
+        job_id : {string}
+            identifier of a queued job
+    """
+    with jobs_lock:
+        job = jobs[job_id]
+        params = job.pop("params")
+
+        job["status"] = "running"
+        job["timings"]["queued"] = time.time() - job["submitted_at"]
+
+    start = time.time()
+
+    # the engine runs outside the lock; results are published in one update
+    try:
+        bot_engine = Engine(
+            params["user_id"], json.dumps(params["configuration"]),
+            page_access_token=params["page_access_token"],
+            verification_token=params["verification_token"],
+            mongo_host=os.environ["MONGO_HOST"], client=client)
+
+        bot_engine.process()
+
+        result = {
+            "status": "finished",
+            "artifacts": artifact_digests(bot_engine.output_dir,
+                                          params.get("include_artifacts")),
+            "steps": bot_engine.timings
+        }
+    except Exception as e:
+        result = {
+            "status": "failed",
+            "error": "%s: %s" % (type(e).__name__, e)
+        }
+
+    with jobs_lock:
+        job["timings"]["run"] = time.time() - start
+
+        if "steps" in result:
+            job["timings"]["steps"] = result.pop("steps")
+
+        job.update(result)
+
+        evict_finished_jobs()
+
+
+def evict_finished_jobs():
+    """
+        Drop the oldest completed jobs once more than MAX_FINISHED are kept.
+        Must be called while holding jobs_lock.
+    """
+    finished = [job_id for job_id, job in jobs.iteritems()
+                if job["status"] in ("finished", "failed")]
+
+    for job_id in finished[:max(0, len(finished) - MAX_FINISHED)]:
+        del jobs[job_id]
+
+
+@app.route("/bots", methods=["POST"])
+def create_bot():
+    params = request.get_json(silent=True)
+
+    if not isinstance(params, dict):
+        return jsonify(error="request body must be a JSON object"), 400
+
+    missing = [field for field in ["user_id", "page_access_token",
+                                   "verification_token", "configuration"]
+               if field not in params]
+
+    if missing:
+        return jsonify(error="missing fields: %s" % ", ".join(missing)), 400
+
+    if not isinstance(params["user_id"], basestring) or \
+            not USER_ID_PATTERN.match(params["user_id"]):
+        return jsonify(error="user_id may only contain letters, digits, "
+                             "underscores, and hyphens"), 400
+
+    with jobs_lock:
+        active = [job for job in jobs.itervalues()
+                  if job["status"] in ("queued", "running")]
+
+        if len(active) >= MAX_PENDING:
+            return jsonify(error="generation queue is full"), 503
+
+        # jobs for the same user write to the same output directory
+        if params["user_id"] in [job["user_id"] for job in active]:
+            return jsonify(error="a job for this user_id is in progress"), 409
+
+        job_id = uuid.uuid4().hex
+
+        jobs[job_id] = {
+            "job_id": job_id,
+            "user_id": params["user_id"],
+            "status": "queued",
+            "submitted_at": time.time(),
+            "timings": {},
+            "params": params
+        }
+
+    pool.apply_async(run_job, (job_id,))
+
+    return jsonify(job_id=job_id, status="queued"), 202
+
+
+@app.route("/jobs/<job_id>", methods=["GET"])
+def job_status(job_id):
+    # copy under the lock - workers update jobs while they are polled
+    with jobs_lock:
+        job = jobs.get(job_id)
+
+        if job is not None:
+            job = copy.deepcopy(dict((field, value) for field, value
+                                     in job.iteritems() if field != "params"))
+
+    if job is None:
+        return jsonify(error="unknown job"), 404
+
+    return jsonify(job), 200
+
+
+@app.route("/health", methods=["GET"])
+def health():
+    with jobs_lock:
+        counts = collections.Counter(job["status"] for job in jobs.itervalues())
+
+    return jsonify(workers=WORKERS, max_pending=MAX_PENDING, jobs=counts), 200
+
+
+if __name__ == "__main__":
+    app.run(host="0.0.0.0", port=int(os.environ.get("PORT", 8000)),
+            threaded=True)
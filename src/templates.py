@@ -4,12 +4,22 @@
 base_application_logic = \
 """
 import os
+import copy
+import hmac
+import re
 import json
+import math
+import random
+import pstats
+import cProfile
+import functools
+import threading
 import datetime as dt
+from StringIO import StringIO
 
 import requests
 from pymongo import MongoClient
-from flask import Flask, jsonify, request
+from flask import Flask, jsonify, request, send_file
 
 from content import *
 import state as st
@@ -18,8 +28,228 @@ app = Flask(__name__)
 
 # mongo constants
 client = MongoClient("~mongo_host~")
-db = client["~user_id~"]
+db = client["~database_name~"]
 state_coll = db["state"]
+state_archive_coll = db["state_archive"]
+
+# tenant fields added to every state and data record - empty unless the bot
+# shares its database with other tenants
+TENANT_FIELDS = ~tenant_fields~
+
+# state helpers
+def state_key(sender_id):
+    key = {"user_id": sender_id}
+    key.update(TENANT_FIELDS)
+    return key
+
+
+def load_state(sender_id):
+    now = dt.datetime.utcnow()
+
+    # existing users only need last_seen refreshed - one round trip
+    result = state_coll.update(state_key(sender_id), {
+        "$set": {
+            "last_seen": now
+        }
+    }, upsert=False)
+
+    if result["n"]:
+        return
+
+    # create a state map for the user from the template - copy so that the
+    # module level template is never mutated between users
+    state_map = copy.deepcopy(st.state_map)
+
+    archived = state_archive_coll.find_one(state_key(sender_id))
+
+    if archived:
+        # lazily restore an inactive user's progress onto the fresh template
+        for field, value in archived.iteritems():
+            if field == "_id":
+                continue
+
+            node = state_map.get(field)
+
+            if isinstance(value, dict) and "switch" in value:
+                # node progress - skip nodes removed from the bot since the
+                # user was archived
+                if not isinstance(node, dict) or "switch" not in node:
+                    continue
+
+                node["switch"] = value.get("switch", False)
+                node["index"] = value.get("index", 0)
+
+                # the message list shrank - switch the node off so the user
+                # starts from the default carousel again
+                if node["index"] >= node["length"]:
+                    node["switch"] = False
+                    node["index"] = 0
+            elif isinstance(node, dict) and isinstance(value, dict):
+                state_map[field].update(value)
+            else:
+                state_map[field] = value
+
+    state_map["user_id"] = sender_id
+    state_map["last_seen"] = now
+    state_map.update(TENANT_FIELDS)
+    state_coll.insert(state_map)
+
+    if archived:
+        state_archive_coll.remove({"_id": archived["_id"]})
+
+
+# profiling constants - capture is armed by PROFILE_REQUESTS at startup or
+# through the /profile route, and switches itself off once the requested
+# number of webhook calls has been captured
+PROFILE_DIR = os.environ.get("PROFILE_DIR", "/tmp")
+MAX_PROFILE_REQUESTS = 1000
+MIN_PROFILE_SAMPLE_RATE = 0.001
+MAX_PROFILE_LINES = 500
+PROFILE_SORT_KEYS = ["calls", "cumulative", "filename", "line", "module",
+                     "name", "ncalls", "nfl", "pcalls", "stdname", "time",
+                     "tottime"]
+profile_lock = threading.Lock()
+profile_capture = {
+    "remaining": max(0, min(int(os.environ.get("PROFILE_REQUESTS", 0)),
+                            MAX_PROFILE_REQUESTS)),
+    "sample_rate": max(MIN_PROFILE_SAMPLE_RATE, min(
+        float(os.environ.get("PROFILE_SAMPLE_RATE", 1.0)), 1.0)),
+    "captured": 0,
+    "stats": None,
+    "output": None
+}
+
+# profiling helpers
+def profiled(view):
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        # unprofiled requests only pay for this check
+        if profile_capture["remaining"] <= 0 or \
+                random.random() >= profile_capture["sample_rate"]:
+            return view(*args, **kwargs)
+
+        profiler = cProfile.Profile()
+
+        try:
+            return profiler.runcall(view, *args, **kwargs)
+        finally:
+            record_profile(profiler)
+
+    return wrapper
+
+
+def record_profile(profiler):
+    with profile_lock:
+        if profile_capture["remaining"] <= 0:
+            return
+
+        if profile_capture["stats"] is None:
+            profile_capture["stats"] = pstats.Stats(profiler)
+        else:
+            profile_capture["stats"].add(profiler)
+
+        profile_capture["remaining"] -= 1
+        profile_capture["captured"] += 1
+
+        if profile_capture["remaining"] == 0:
+            # capture complete - write pstats output for offline analysis
+            output = os.path.join(PROFILE_DIR, "profile-%s-%s.pstats" % (
+                dt.datetime.utcnow().strftime("%Y%m%dT%H%M%S"), os.getpid()))
+            profile_capture["stats"].dump_stats(output)
+            profile_capture["output"] = output
+
+
+def profile_authorized():
+    # read from a header - query strings end up in the router logs
+    token = os.environ.get("PROFILE_TOKEN")
+    supplied = request.headers.get("X-Profile-Token")
+
+    if not token or not supplied:
+        return False
+
+    to_bytes = lambda value: \
+        value.encode("utf-8") if isinstance(value, unicode) else value
+
+    return hmac.compare_digest(to_bytes(token), to_bytes(supplied))
+
+
+def bounded_arg(name, default, cast, low, high):
+    # raises ValueError for malformed or out of range query arguments
+    value = cast(request.args.get(name, default))
+
+    if not low <= value <= high:
+        raise ValueError("%s must be between %s and %s" % (name, low, high))
+
+    return value
+
+
+# input coercion - each coercer raises ValueError for answers that do not
+# match the message's expected input
+date_formats = ["%d-%m-%Y", "%d/%m/%Y", "%Y-%m-%d", "%d %B %Y", "%B %d, %Y",
+                "%b %d, %Y"]
+
+# mongo stores integers as signed 64 bit values
+MIN_INTEGER = -2 ** 63
+MAX_INTEGER = 2 ** 63 - 1
+
+# commas are only accepted as thousands separators (e.g. 1,200.50)
+thousands_pattern = re.compile(r"^[+-]?\d{1,3}(,\d{3})+(\.\d*)?$")
+
+def parse_number(text, number_type):
+    text = text.lstrip("$")
+
+    if "," in text:
+        if not thousands_pattern.match(text):
+            raise ValueError("misplaced thousands separator: %s" % text)
+
+        text = text.replace(",", "")
+
+    number = number_type(text)
+
+    if number_type is int:
+        # larger integers cannot be encoded and would fail the state write
+        if not MIN_INTEGER <= number <= MAX_INTEGER:
+            raise ValueError("integer out of range: %s" % text)
+
+    # float() accepts "nan", "inf", and overflowing exponents like "1e999"
+    elif math.isnan(number) or math.isinf(number):
+        raise ValueError("non-finite number: %s" % text)
+
+    return number
+
+
+def parse_date(text):
+    for date_format in date_formats:
+        try:
+            return dt.datetime.strptime(text, date_format)
+        except ValueError:
+            continue
+
+    raise ValueError("unrecognized date: %s" % text)
+
+
+input_coercers = {
+    "integer": lambda text: parse_number(text, int),
+    "float": lambda text: parse_number(text, float),
+    "date": parse_date,
+    "text": lambda text: text
+}
+
+reprompts = {
+    "integer": "Sorry, please answer with a whole number.",
+    "float": "Sorry, please answer with a number.",
+    "date": "Sorry, please answer with a date (e.g. 31-12-1990).",
+    "text": "Sorry, please answer with text."
+}
+
+def coerce_input(content_name, message):
+    expected = st.input_table.get(content_name)
+
+    if expected is None:
+        return message
+
+    return input_coercers[expected](message.strip())
+
 
 # message sending helper
 def send_message(sender_id, message_data):
@@ -51,7 +281,67 @@ def verify():
 
     return "Application Verified!", 200
 
+@app.route("/profile", methods=["GET", "POST"])
+def profile():
+    if not profile_authorized():
+        return "Not found", 404
+
+    if request.method == "POST":
+        try:
+            requests_arg = bounded_arg("requests", 50, int, 1,
+                                       MAX_PROFILE_REQUESTS)
+            sample_rate = bounded_arg("sample_rate", 1.0, float,
+                                      MIN_PROFILE_SAMPLE_RATE, 1.0)
+        except ValueError as e:
+            return str(e), 400
+
+        # arm a new capture, discarding the previous one
+        with profile_lock:
+            profile_capture["remaining"] = requests_arg
+            profile_capture["sample_rate"] = sample_rate
+            profile_capture["captured"] = 0
+            profile_capture["stats"] = None
+            profile_capture["output"] = None
+
+    return jsonify(remaining=profile_capture["remaining"],
+                   sample_rate=profile_capture["sample_rate"],
+                   captured=profile_capture["captured"],
+                   output=profile_capture["output"],
+                   pid=os.getpid()), 200
+
+@app.route("/profile/stats", methods=["GET"])
+def profile_stats():
+    if not profile_authorized():
+        return "Not found", 404
+
+    if profile_capture["output"] is None:
+        return "No completed capture", 404
+
+    if request.args.get("format") == "pstats":
+        return send_file(profile_capture["output"],
+                         mimetype="application/octet-stream",
+                         as_attachment=True)
+
+    sort = request.args.get("sort", "cumulative")
+
+    if sort not in PROFILE_SORT_KEYS:
+        return "sort must be one of %s" % ", ".join(PROFILE_SORT_KEYS), 400
+
+    try:
+        limit = bounded_arg("limit", 50, int, 1, MAX_PROFILE_LINES)
+    except ValueError as e:
+        return str(e), 400
+
+    # plain text summary of the hottest call paths
+    stream = StringIO()
+    stats = pstats.Stats(profile_capture["output"], stream=stream)
+    stats.sort_stats(sort)
+    stats.print_stats(limit)
+
+    return stream.getvalue(), 200, {"Content-Type": "text/plain"}
+
 @app.route("/", methods=["POST"])
+@profiled
 ~webhook_logic~
 
 if __name__ == "__main__":
@@ -68,22 +358,19 @@ def webhook():
             for messaging_event in entry["messaging"]:
                 sender_id = messaging_event["sender"]["id"]
 
-                if not state_coll.find_one({"user_id": sender_id}):
-                    # create a state map for the user - should only take place once
-                    state_map = st.state_map
-                    state_map["user_id"] = sender_id
-                    state_coll.insert(state_map)
+                # create, restore, or refresh the user's state map
+                load_state(sender_id)
 
                 if messaging_event.get("postback"):
                     # detect previous state to know if flow has been instantiated
-                    if state_coll.find_one({"user_id": sender_id})["current_type"] == "message_list":
-                        state_coll.update({"user_id": sender_id}, {
+                    if state_coll.find_one(state_key(sender_id))["current_type"] == "message_list":
+                        state_coll.update(state_key(sender_id), {
                             "$set": {
                                 "flow_instantiated": True
                             }
                         }, upsert=False)
 
-                    state_coll.update({"user_id": sender_id}, {
+                    state_coll.update(state_key(sender_id), {
                         "$set": {
                             "current_type": "postback"
                         }
@@ -98,22 +385,15 @@ def webhook():
                     # user submitted a message response (text)
                     message = messaging_event["message"]["text"]
 
-                    # set the current state to message list
-                    state_coll.update({"user_id": sender_id}, {
-                        "$set": {
-                            "current_type": "message_list"
-                        }
-                    }, upsert=False)
-
                     # find out what node has been turned on
-                    state_map = state_coll.find_one({"user_id": sender_id})
+                    state_map = state_coll.find_one(state_key(sender_id))
 
                     switch_node = None
 
                     info = None
 
                     ignore_fields = ["_id", "user_id", "current_type", "data", 
-                                     "flow_instantiated"]
+                                     "flow_instantiated", "last_seen", "tenant_id"]
 
                     for node, node_info in state_map.iteritems():
                         # nodes to ignore in state map
@@ -126,7 +406,7 @@ def webhook():
 
                     if switch_node is None:
                         # detected first time interaction between user and application
-                        state_coll.update({"user_id": sender_id}, {
+                        state_coll.update(state_key(sender_id), {
                             "$set": {
                                 "current_type": "message_list"
                             }
@@ -135,31 +415,51 @@ def webhook():
                         send_message(sender_id, content_data["default"])
                         continue
 
+                    # validate and type the answer before any state is written
+                    content_name = "%s_%s" % (switch_node, info["index"])
+
+                    try:
+                        message = coerce_input(content_name, message)
+                    except ValueError:
+                        # re-prompt with the same message - the index is unchanged
+                        send_message(sender_id, {
+                            "text": reprompts[st.input_table[content_name]]
+                        })
+                        send_message(sender_id, content_data[content_name])
+                        continue
+
+                    # set the current state to message list
+                    state_coll.update(state_key(sender_id), {
+                        "$set": {
+                            "current_type": "message_list"
+                        }
+                    }, upsert=False)
+
                     # we've reached the end of a message list
                     flag_1 = info["index"] >= (info["length"] - 1)
 
                     flag_2 = info["length"] == 1
 
-                    flag_3 = state_coll.find_one({"user_id": sender_id})["flow_instantiated"]
+                    flag_3 = state_coll.find_one(state_key(sender_id))["flow_instantiated"]
 
                     # detect the end of a flow
                     if flag_1 or (flag_2 and flag_3):
                         # reset list index
-                        state_coll.update({"user_id": sender_id}, {
+                        state_coll.update(state_key(sender_id), {
                             "$set": {
                                 "%s.index" % switch_node: 0
                             }
                         }, upsert=False)
 
                         # flip the node switch
-                        state_coll.update({"user_id": sender_id}, {
+                        state_coll.update(state_key(sender_id), {
                             "$set": {
                                 "%s.switch" % switch_node: False
                             }
                         }, upsert=False)
 
                         # flip flow switch
-                        state_coll.update({"user_id": sender_id}, {
+                        state_coll.update(state_key(sender_id), {
                             "$set": {
                                 "%s.flow_instantiated" % switch_node: False
                             }
@@ -172,13 +472,13 @@ def webhook():
                         if "storage" in info["list"][info["index"]]:
                             storage_det = "_".join(info["list"][info["index"]]["storage"].split("."))
 
-                            state_coll.update({"user_id": sender_id}, {
+                            state_coll.update(state_key(sender_id), {
                                 "$set": {
                                     "data.%s" % storage_det: message
                                 }
                             }, upsert=False)
 
-                        data = state_coll.find_one({"user_id": sender_id})["data"]
+                        data = state_coll.find_one(state_key(sender_id))["data"]
 
                         for storage, datum in data.iteritems():
                             storage_info = storage.split("_")
@@ -196,6 +496,7 @@ def webhook():
                                 record["date"] = dt.datetime.today().strftime("%d-%m-%Y") 
 
                             record["user_id"] = sender_id
+                            record.update(TENANT_FIELDS)
 
                             data_coll = db[coll]
 
@@ -206,7 +507,7 @@ def webhook():
 
                         if target_is_ml:
                             # flip the target switch as it exists in the state map
-                            state_coll.update({"user_id": sender_id}, {
+                            state_coll.update(state_key(sender_id), {
                                 "$set": {
                                     "%s.switch" % info["target"]: True
                                 }
@@ -228,14 +529,14 @@ def webhook():
                     storage = "_".join(storage.split("."))
 
                     # store the response 
-                    state_coll.update({"user_id": sender_id}, {
+                    state_coll.update(state_key(sender_id), {
                         "$set": {
                             "data.%s" % storage: message
                         }
                     }, upsert=False)
 
                     # increment the list index
-                    state_coll.update({"user_id": sender_id}, {
+                    state_coll.update(state_key(sender_id), {
                         "$set": {
                             "%s.index" % switch_node: curr_idx + 1
                         }
@@ -254,6 +555,7 @@ def webhook():
                 elif messaging_event.get("optin"):
                     # confirm optin - currently not supported
                     pass
+
     return "ok", 200
 """
 
@@ -261,7 +563,7 @@ def webhook():
 postback_logic = \
 """
                     if message_payload == "~payload~":
-                        state_coll.update({"user_id": sender_id}, {
+                        state_coll.update(state_key(sender_id), {
                             "$set": {
                                 "~target~.switch": True
                             }
@@ -1,6 +1,9 @@
 """
 	Helper functions to be used in Engine class.
 """
+# placeholders found in each template string - templates are module level
+# constants, so long running processes only scan each one once
+template_cache = {}
 
 def format_string(string_template, **kwargs):
     """
@@ -17,6 +20,30 @@ def format_string(string_template, **kwargs):
     """
     template_char = '~'
 
+    templates = template_cache.get(string_template)
+
+    if templates is None:
+        templates = find_templates(string_template, template_char)
+        template_cache[string_template] = templates
+
+    for tpl in templates:
+        string_template = string_template.replace(tpl, str(kwargs[tpl[1:-1]]))
+
+    return string_template
+
+
+def find_templates(string_template, template_char):
+    """
+        Locate all template placeholders (e.g. ~name~) in a string.
+
+        Parameters
+        ----------
+        string_template : {str}
+            string to be scanned for placeholders
+
+        template_char : {str}
+            character delimiting placeholders
+    """
     # identify all occurences of templates
     idx = 0
 
@@ -36,8 +63,5 @@ def format_string(string_template, **kwargs):
         templates.append(string_template[start_idx:end_idx+1])
         idx = end_idx+1
 
-    for tpl in templates:
-        string_template = string_template.replace(tpl, str(kwargs[tpl[1:-1]]))
-
-    return string_template
+    return templates
     
\ No newline at end of file